@@ -1,13 +1,31 @@
 import argparse
-import json
+import asyncio
+import logging
+import os
 import sqlite3
-from datetime import datetime
+import sys
+import tomllib
+from contextlib import asynccontextmanager
 from typing import Dict, Any
 
+import aiosqlite
 import uvicorn
-import yaml
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel, ValidationError
+from aiosqlitepool import SQLiteConnectionPool
+from fastapi import FastAPI, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+log = logging.getLogger("cybercare.consumer")
+
+# Kept as one constant so sqlite3's per-connection statement cache always hits
+INSERT_SQL = ("INSERT INTO events (event_type, event_payload, received_at) "
+              "VALUES (?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))")
+
+# The success response never changes, so its body is encoded once up front
+QUEUED_RESPONSE = b'{"status":"queued","message":"Event queued for saving"}'
+
+# How many times a batch is written before its events are given up on
+WRITE_ATTEMPTS = 5
 
 
 class EventModel(BaseModel):
@@ -20,12 +38,30 @@ class DatabaseManager:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
         self.db_path = config.get('path', 'events.db')
+        self.batch_size = config.get('batch_size', 1000)
+        self.flush_interval = config.get('flush_interval_ms', 50) / 1000
         self.init_database()
+        # Long-lived connections keep SQLite's page cache warm between requests
+        self.pool = SQLiteConnectionPool(self._connect)
+        # Incoming events are buffered here and written in batches by the flusher task
+        self.queue = asyncio.Queue(maxsize=10_000)
+        self.flusher_task = None
 
     def init_database(self):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        # The journal mode is stored in the database file, so it only has to be switched once
+        cursor.execute('PRAGMA journal_mode=WAL')
+
+        # Tables created before the AUTOINCREMENT keyword was dropped are rebuilt, keeping their rows and ids
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'events'")
+        row = cursor.fetchone()
+        migrate = row is not None and 'AUTOINCREMENT' in row[0].upper()
+        if migrate:
+            cursor.execute('BEGIN')
+            cursor.execute('ALTER TABLE events RENAME TO events_old')
+
         cursor.execute('''
                        CREATE TABLE IF NOT EXISTS events
                        (
@@ -33,7 +69,8 @@ class DatabaseManager:
                            INTEGER
                            PRIMARY
                            KEY
-                           AUTOINCREMENT,
+                           NOT
+                           NULL,
                            event_type
                            TEXT
                            NOT
@@ -53,41 +90,119 @@ class DatabaseManager:
                        )
                        ''')
 
-        conn.commit()
-        conn.close()
-        print(f'Database initialized: {self.db_path}')
-
-    def save_event(self, event_type: str, event_payload: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        current_time = datetime.now().isoformat()
-
-        cursor.execute('''
-                       INSERT INTO events (event_type, event_payload, received_at)
-                       VALUES (?, ?, ?)
-                       ''', (event_type, event_payload, current_time))
+        if migrate:
+            cursor.execute('''
+                           INSERT INTO events (id, event_type, event_payload, received_at, created_at)
+                           SELECT id, event_type, event_payload, received_at, created_at
+                           FROM events_old
+                           ''')
+            cursor.execute('DROP TABLE events_old')
 
-        event_id = cursor.lastrowid
         conn.commit()
+        if migrate:
+            # Reclaims the old table's pages and removes the now empty sqlite_sequence table
+            cursor.execute('VACUUM')
         conn.close()
+        print(f'Database initialized: {self.db_path}')
 
-        return event_id
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.db_path)
+        await conn.executescript('''
+                                 PRAGMA journal_mode=WAL;
+                                 PRAGMA synchronous=NORMAL;
+                                 PRAGMA cache_size=-65536;
+                                 PRAGMA temp_store=MEMORY;
+                                 PRAGMA mmap_size=268435456;
+                                 ''')
+        return conn
+
+    def start(self):
+        self.flusher_task = asyncio.create_task(self._flusher())
+
+    async def save_event(self, event_type: str, event_payload: str) -> None:
+        await self.queue.put((event_type, event_payload))
+
+    async def _flusher(self):
+        """Collects up to `batch_size` events or waits `flush_interval` seconds, then writes them in one transaction"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            event = await self.queue.get()
+            if event is None:
+                break
+
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+
+            await self._write_batch_with_retry(batch)
+
+    async def _write_batch_with_retry(self, batch):
+        # The events were already acknowledged, so transient errors such as SQLITE_BUSY are retried with backoff
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                await self._write_batch(batch)
+                return
+            except Exception:
+                if attempt == WRITE_ATTEMPTS:
+                    log.exception('Failed to save %d events after %d attempts', len(batch), attempt)
+                    return
+                delay = 0.1 * 2 ** (attempt - 1)
+                log.warning('Failed to save %d events, retrying in %.1f seconds', len(batch), delay, exc_info=True)
+                await asyncio.sleep(delay)
+
+    async def _write_batch(self, batch):
+        async with self.pool.connection() as conn:
+            await conn.executemany(INSERT_SQL, batch)
+            await conn.commit()
+
+        log.debug('Saved %d events', len(batch))
+
+    async def close(self):
+        if self.flusher_task is not None:
+            # The sentinel is queued behind pending events, so they are flushed before the task exits
+            await self.queue.put(None)
+            await self.flusher_task
+            self.flusher_task = None
+        await self.pool.close()
 
 
 class EventConsumer:
     """The second service (Event consumer)"""
 
-    def __init__(self, config_file="config.yaml"):
+    def __init__(self, config_file="config.toml", db_path=None):
         self.config = self.load_config(config_file)
+        # The persistent storage parameters for the incoming payloads should be configurable via a configuration file
+        if db_path:
+            self.config['database']['path'] = db_path
         self.db_manager = DatabaseManager(self.config['database'])
-        self.app = FastAPI(title="Event Consumer", version="1.0.0")
+        self.app = FastAPI(title="Event Consumer", version="1.0.0", default_response_class=ORJSONResponse,
+                           lifespan=self.lifespan)
         self.setup_routes()
 
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        """Runs the database flusher for as long as the app is serving requests"""
+        self.db_manager.start()
+        yield
+        await self.db_manager.close()
+
     def load_config(self, config_file):
         try:
-            with open(config_file, 'r', encoding='utf-8') as file:
-                config = yaml.safe_load(file)
+            with open(config_file, 'rb') as file:
+                config = tomllib.load(file)
                 return config['event_consumer']
         except FileNotFoundError:
             print(f'Configuration file {config_file} not found. Using default values.')
@@ -101,51 +216,16 @@ class EventConsumer:
 
     def setup_routes(self):
         @self.app.post("/event")
-        async def receive_event(request: Request):
+        async def receive_event(event: EventModel):
             """The service should expose a HTTP API endpoint that accepts incoming POST requests on the path `/event`"""
-            try:
-                event_data = await request.json()
+            await self.db_manager.save_event(
+                event.event_type,
+                event.event_payload
+            )
 
-                try:
-                    event = EventModel(**event_data)
-                except ValidationError as e:
-                    error_msg = f'Invalid data format: {str(e)}'
-                    print(f'Validation error: {error_msg}')
-                    print(f'Received data: {event_data}')
-                    raise HTTPException(
-                        status_code=400,
-                        detail=error_msg
-                    )
-
-                event_id = self.db_manager.save_event(
-                    event.event_type,
-                    event.event_payload
-                )
-
-                print(f'Event saved (ID: {event_id}): {event.event_type} - {event.event_payload}')
-
-                return {
-                    "status": "success",
-                    "message": "Event saved successfully",
-                    "event_id": event_id
-                }
+            log.debug('Event queued: %s - %s', event.event_type, event.event_payload)
 
-            except json.JSONDecodeError:
-                error_msg = "Invalid JSON format"
-                print(f'JSON error: {error_msg}')
-                raise HTTPException(
-                    status_code=400,
-                    detail=error_msg
-                )
-            except HTTPException:
-                raise
-            except Exception as e:
-                error_msg = f'Internal server error: {str(e)}'
-                print(f'Unknown error: {error_msg}')
-                raise HTTPException(
-                    status_code=500,
-                    detail="Internal server error"
-                )
+            return Response(content=QUEUED_RESPONSE, media_type="application/json")
 
         @self.app.get("/")
         async def root():
@@ -156,41 +236,68 @@ class EventConsumer:
             }
 
 
+def create_consumer():
+    """Builds the consumer from the configuration file and overrides passed down by `main` through the environment"""
+    return EventConsumer(
+        os.environ.get('EVENT_CONSUMER_CONFIG', 'config.toml'),
+        os.environ.get('EVENT_CONSUMER_DB_PATH')
+    )
+
+
+def create_app():
+    """App factory used by uvicorn to build a separate app in every worker process"""
+    return create_consumer().app
+
+
 def parse_arguments():
     """Processes command line arguments"""
     parser = argparse.ArgumentParser(description='Event consumer')
-    parser.add_argument('--config', default='config.yaml',
+    parser.add_argument('--config', default='config.toml',
                         help='Configuration file path')
     parser.add_argument('--port', type=int,
                         help='Server port (overrides configuration)')
     parser.add_argument('--db-path',
                         help='Database file path (overrides configuration)')
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes (overrides configuration)')
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    consumer = EventConsumer(args.config)
 
-    # The persistent storage parameters for the incoming payloads should be configurable via a configuration file
+    # Worker processes build their own app, so the overrides are handed to them through the environment
+    os.environ['EVENT_CONSUMER_CONFIG'] = args.config
+    if args.db_path:
+        os.environ['EVENT_CONSUMER_DB_PATH'] = args.db_path
+
+    # Creating the consumer here also sets up the database schema once, before any worker starts
+    consumer = create_consumer()
+
     if args.port:
         consumer.config['port'] = args.port
-    if args.db_path:
-        consumer.config['database']['path'] = args.db_path
-        consumer.db_manager = DatabaseManager(consumer.config['database'])
+    if args.workers:
+        consumer.config['workers'] = args.workers
 
     port = consumer.config['port']
+    workers = consumer.config.get('workers', os.cpu_count())
 
     print(f'Starting event consumer...')
     print(f'Server: http://localhost:{port}')
     print(f'API endpoint: http://localhost:{port}/event')
     print(f'Database: {consumer.config['database']['path']}')
+    print(f'Workers: {workers}')
 
     uvicorn.run(
-        consumer.app,
+        "event_consumer:create_app",
+        factory=True,
+        workers=workers,
         host="0.0.0.0",
         port=port,
-        log_level="info"
+        # uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        log_level="warning"
     )
 
 
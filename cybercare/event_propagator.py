@@ -1,24 +1,34 @@
 # event_propagator.py
 import argparse
 import asyncio
-import json
 import random
+import tomllib
 
 import httpx
-import yaml
+import orjson
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop is not available on Windows
+    uvloop = None
 
 class EventPropagator:
     """The first service (Event propagator)"""
 
-    def __init__(self, config_file="config.yaml"):
+    def __init__(self, config_file="config.toml"):
         self.config = self.load_config(config_file)
-        self.events = self.load_events()
+        # Loaded by start(), after command line overrides have been applied to the config
+        self.events = ()
+        self.randrange = random.Random().randrange
+        self.client = None
+        # Upper bound on requests that may be in flight to the consumer at once
+        self.semaphore = asyncio.Semaphore(32)
 
     def load_config(self, config_file):
         try:
-            with open(config_file, 'r', encoding='utf-8') as file:
-                config = yaml.safe_load(file)
+            with open(config_file, 'rb') as file:
+                config = tomllib.load(file)
                 return config['event_propagator']
         except FileNotFoundError:
             print(f'Configuration file {config_file} not found. Using default values.')
@@ -32,42 +42,48 @@ class EventPropagator:
         """The predefined JSON objects(events) that can be sent should be read from a file"""
         events_file = self.config['events_file']
         try:
-            with open(events_file, 'r', encoding='utf-8') as file:
-                events = json.load(file)
+            with open(events_file, 'rb') as file:
+                # Events are encoded once here, so each tick sends ready-made request bodies
+                events = tuple(orjson.dumps(event) for event in orjson.loads(file.read()))
                 print(f'Loaded {len(events)} events from {events_file}')
                 return events
         except FileNotFoundError:
             print(f'Events file {events_file} not found!')
-            return []
-        except json.JSONDecodeError:
+            return ()
+        except orjson.JSONDecodeError:
             print(f'Error reading JSON file {events_file}')
-            return []
+            return ()
 
     def get_random_event(self):
         """
         The algorithm for choosing a specific JSON object(event) to send at each period
         from all the objects read from file, should be random
         """
-        if not self.events:
+        events = self.events
+        if not events:
             return None
-        return random.choice(self.events)
+        return events[self.randrange(len(events))]
 
     async def send_event(self, event):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.config['api_endpoint'],
-                    json=event,
-                    headers={"Content-Type": "application/json"}
-                )
-                if response.status_code == 200:
-                    print(f'Event sent successfully: {event}')
-                else:
-                    print(f'Error sending event: {response.status_code} - {response.text}')
+            response = await self.client.post(
+                self.config['api_endpoint'],
+                content=event,
+                headers={"Content-Type": "application/json"}
+            )
+            if response.status_code == 200:
+                print(f'Event sent successfully: {event.decode()}')
+            else:
+                print(f'Error sending event: {response.status_code} - {response.text}')
         except Exception as e:
             print(f'Failed to send event: {e}')
 
+    async def send_event_limited(self, event):
+        async with self.semaphore:
+            await self.send_event(event)
+
     async def start(self):
+        self.events = self.load_events()
         if not self.events:
             print(f'No events available to send!')
             return
@@ -77,22 +93,40 @@ class EventPropagator:
         print(f'Interval: {self.config['interval_seconds']} seconds')
         print(f'Available events: {len(self.events)}')
 
-        try:
-            while True:
-                event = self.get_random_event()
-                if event:
-                    await self.send_event(event)
+        # A single client keeps the connection to the consumer alive between events
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(5.0, connect=1.0),
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60)
+        )
+
+        loop = asyncio.get_running_loop()
+        # The period of time should be measured in seconds
+        interval = self.config['interval_seconds']
+        next_time = loop.time()
 
-                # The period of time should be measured in seconds
-                await asyncio.sleep(self.config['interval_seconds'])
+        try:
+            # Sends run as tasks, so a slow consumer does not hold back the next tick
+            async with asyncio.TaskGroup() as tasks:
+                while True:
+                    event = self.get_random_event()
+                    if event:
+                        tasks.create_task(self.send_event_limited(event))
+
+                    # Ticks are scheduled from a fixed start time so send latency does not add up,
+                    # and a small jitter keeps several propagators from hitting the consumer in lockstep
+                    next_time = max(next_time + interval, loop.time())
+                    jitter = random.uniform(-0.05, 0.05) * interval
+                    await asyncio.sleep(max(0.0, next_time + jitter - loop.time()))
 
         except KeyboardInterrupt:
             print('\nEvent propagator stopped')
+        finally:
+            await self.client.aclose()
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Event propagator')
-    parser.add_argument('--config', default='config.yaml',
+    parser.add_argument('--config', default='config.toml',
                         help='Configuration file path')
     parser.add_argument('--interval', type=int,
                         help='Interval in seconds (overrides configuration)')
@@ -113,10 +147,12 @@ async def main():
         propagator.config['api_endpoint'] = args.endpoint
     if args.events_file:
         propagator.config['events_file'] = args.events_file
-        propagator.events = propagator.load_events()
 
     await propagator.start()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())